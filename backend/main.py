@@ -1,15 +1,19 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
 import os
 from dotenv import load_dotenv
 import json
-from typing import Dict, List
+import secrets
+import asyncio
+from typing import Dict, List, Optional
 from datetime import datetime
 import uvicorn
 
 from services.calendar_service import CalendarService
 from services.conversation_service import ConversationService
+from services.profiler import profiler
+from services.deadline import Deadline
 from models.schemas import Message, ConversationState
 
 load_dotenv()
@@ -36,7 +40,8 @@ async def root():
         "endpoints": {
             "health": "/health",
             "auth": "/auth/login",
-            "websocket": "/ws/{client_id}"
+            "websocket": "/ws/{client_id}",
+            "profiling": "/admin/profiling"
         }
     }
 
@@ -76,15 +81,86 @@ async def auth_status():
     }
 
 
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Admin endpoints need ADMIN_TOKEN in the X-Admin-Token header; without ADMIN_TOKEN they are off"""
+    admin_token = os.getenv("ADMIN_TOKEN", "")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.get("/admin/profiling", dependencies=[Depends(require_admin)])
+async def profiling_status():
+    """Show profiler settings, recent profiles and the measured overhead when disabled"""
+    return {
+        **profiler.status(),
+        "disabled_overhead_ns": round(await asyncio.to_thread(profiler.measure_disabled_overhead), 1),
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+@app.post("/admin/profiling", dependencies=[Depends(require_admin)])
+async def configure_profiling(
+    enabled: Optional[bool] = None,
+    sample_rate: Optional[float] = None,
+    next_turns: Optional[int] = None
+):
+    """Turn profiling on/off, set the random sample rate, or profile the next N turns"""
+    return {
+        **profiler.configure(enabled=enabled, sample_rate=sample_rate, next_turns=next_turns),
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+async def run_turn(conversation: ConversationService, user_message: str, deadline: Deadline,
+                   client_id: str, profile: bool) -> Dict:
+    with profiler.session(f"turn-{client_id}", force=profile):
+        return await conversation.process_message(user_message, deadline)
+
+
+async def send_turn_response(websocket: WebSocket, response: Dict, deferred: bool = False):
+    await websocket.send_json({
+        "type": "response",
+        "content": response["message"],
+        "conversation_state": response.get("state", {}),
+        "available_slots": response.get("available_slots", []),
+        "degraded": response.get("degraded", []),
+        "deferred": deferred,
+        "timestamp": datetime.now().isoformat()
+    })
+
+
+async def deliver_late_turn(websocket: WebSocket, turn: asyncio.Task):
+    """Push the result of a turn that outlived its budget once it arrives"""
+    response = await turn
+    try:
+        await send_turn_response(websocket, response, deferred=True)
+    except Exception as e:
+        print(f"Could not deliver late response: {str(e)}")
+
+
+async def cancel_tasks(*tasks: Optional[asyncio.Task]):
+    """Cancel background turn work and wait until it has stopped touching the conversation"""
+    pending = [task for task in tasks if task is not None and not task.done()]
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
     """WebSocket endpoint for real-time conversation"""
     await websocket.accept()
     
     if client_id not in active_conversations:
-        active_conversations[client_id] = ConversationService(calendar_service)
+        active_conversations[client_id] = ConversationService(calendar_service, client_id=client_id)
     
     conversation = active_conversations[client_id]
+    # A turn that outlived its budget, its deadline, and the task that will deliver its result
+    late_turn: Optional[asyncio.Task] = None
+    late_deadline: Optional[Deadline] = None
+    pending_turn: Optional[asyncio.Task] = None
     
     try:
         await websocket.send_json({
@@ -106,17 +182,41 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
                     "timestamp": datetime.now().isoformat()
                 })
                 
-                response = await conversation.process_message(user_message)
+                # Keep conversation history ordered behind a turn still finishing in the background
+                if pending_turn is not None:
+                    # ...but never past its hard limit
+                    await asyncio.wait({pending_turn}, timeout=late_deadline.hard_remaining())
+                    if not pending_turn.done():
+                        print(f"Dropping late turn for {client_id} past its hard limit")
+                    await cancel_tasks(late_turn, pending_turn)
+                    late_turn = pending_turn = None
                 
-                await websocket.send_json({
-                    "type": "response",
-                    "content": response["message"],
-                    "conversation_state": response.get("state", {}),
-                    "available_slots": response.get("available_slots", []),
-                    "timestamp": datetime.now().isoformat()
-                })
+                deadline = Deadline.from_env()
+                turn = asyncio.create_task(run_turn(
+                    conversation, user_message, deadline, client_id, bool(message_data.get("profile"))
+                ))
+                done, _ = await asyncio.wait({turn}, timeout=deadline.remaining())
+                
+                if turn in done:
+                    await send_turn_response(websocket, turn.result())
+                else:
+                    late_turn, late_deadline = turn, deadline
+                    deadline.degrade("still_checking")
+                    await websocket.send_json({
+                        "type": "response",
+                        "content": "Still checking your calendar, one moment.",
+                        "conversation_state": conversation.state.model_dump(),
+                        "available_slots": [],
+                        "degraded": deadline.degradations,
+                        "pending": True,
+                        "timestamp": datetime.now().isoformat()
+                    })
+                    pending_turn = asyncio.create_task(deliver_late_turn(websocket, turn))
             
             elif message_data.get("type") == "reset":
+                # Drop a late turn so it cannot write into the fresh history or answer after the reset
+                await cancel_tasks(late_turn, pending_turn)
+                late_turn = pending_turn = None
                 conversation.reset()
                 await websocket.send_json({
                     "type": "reset_complete",
@@ -135,6 +235,9 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             "message": str(e),
             "timestamp": datetime.now().isoformat()
         })
+    finally:
+        # Stop background LLM/Google work for a client that is gone
+        await cancel_tasks(late_turn, pending_turn)
 
 
 if __name__ == "__main__":
@@ -49,3 +49,24 @@ class ScheduleResponse(BaseModel):
     available_slots: List[Dict[str, Any]]
     message: str
     total_slots_found: int
+
+
+class RoutingDecision(BaseModel):
+    tier: str
+    model: str
+    reason: str
+
+
+class ModelCallRecord(BaseModel):
+    timestamp: datetime
+    client_id: Optional[str] = None
+    conversation_id: Optional[str] = None
+    turn_id: Optional[int] = None
+    purpose: str
+    tier: str
+    model: str
+    reason: str
+    latency_ms: float
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
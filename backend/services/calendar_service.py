@@ -1,8 +1,14 @@
 import os
+import json
 import pickle
+import hashlib
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta, time, timezone
-from typing import List, Dict, Optional, Any, Tuple
+from typing import List, Dict, Optional, Any, Tuple, Callable
 from pathlib import Path
+from time import monotonic
 from zoneinfo import ZoneInfo
 
 from google.auth.transport.requests import Request
@@ -11,6 +17,19 @@ from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from services.profiler import profiled
+from services.rate_limiter import TokenBucket, IntervalSingleFlight, backoff_delay
+from services.deadline import Deadline
+
+
+class CalendarAPIError(Exception):
+    """A Google Calendar call failed (including exhausted rate-limit retries)."""
+
+    def __init__(self, message: str, status: Optional[int] = None, rate_limited: bool = False):
+        super().__init__(message)
+        self.status = status
+        self.rate_limited = rate_limited
+
 
 class CalendarService:
     """
@@ -20,11 +39,17 @@ class CalendarService:
     - Work in the user's local tz for UI/slot generation.
     - Convert to UTC only for comparisons and freeBusy queries.
     - Create events in the user's tz so the Calendar shows the intended local time.
+    - Concurrent overlapping freeBusy queries are coalesced into one in-flight call.
+    - Every API call takes a token from a per-credential bucket and backs off on 403/429
+      rate-limit responses; failures raise CalendarAPIError instead of looking "free".
+    - Under a turn Deadline, a freeBusy call that would overrun the budget falls back
+      to the last known busy intervals for a covering window.
     """
     SCOPES = [
         "https://www.googleapis.com/auth/calendar.readonly",
         "https://www.googleapis.com/auth/calendar.events",
     ]
+    RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded"}
 
     def __init__(self, user_tz: Optional[str] = None):
         # Default to IST for you; override via env or constructor
@@ -32,6 +57,21 @@ class CalendarService:
         self.USER_TZ = ZoneInfo(self.user_tz_name)
         self.creds: Optional[Credentials] = None
         self.service = None
+        self.api_rate = float(os.getenv("GOOGLE_API_RATE", "5"))
+        self.api_burst = float(os.getenv("GOOGLE_API_BURST", "10"))
+        self.api_max_retries = int(os.getenv("GOOGLE_API_MAX_RETRIES", "3"))
+        self.api_acquire_timeout = float(os.getenv("GOOGLE_API_ACQUIRE_TIMEOUT", "10"))
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._buckets_lock = threading.Lock()
+        self._freebusy_flights = IntervalSingleFlight()
+        self.calendar_min_budget = float(os.getenv("CALENDAR_MIN_BUDGET_MS", "300")) / 1000
+        self.stale_busy_max_age = float(os.getenv("STALE_BUSY_MAX_AGE_S", "600"))
+        self._busy_cache: Dict[str, List[Tuple[float, datetime, datetime, List[Dict[str, Any]]]]] = {}
+        self._recent_bookings: Dict[str, List[Tuple[float, datetime, datetime]]] = {}
+        self._busy_cache_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="calendar")
+        self.workday_start = os.getenv("WORKDAY_START", "09:00")
+        self.workday_end = os.getenv("WORKDAY_END", "17:00")
         self.load_credentials()
 
     # ---------------------- TZ helpers ---------------------- #
@@ -120,30 +160,169 @@ class CalendarService:
     def is_authenticated(self) -> bool:
         return self.creds is not None and self.creds.valid
 
+    # ---------------------- Quota handling ---------------------- #
+    def _credential_key(self) -> str:
+        """Stable id for the current credentials, so quota is tracked per credential."""
+        secret = getattr(self.creds, "refresh_token", None) or getattr(self.creds, "token", None) or ""
+        return hashlib.sha256(secret.encode()).hexdigest()[:16]
+
+    def _bucket(self) -> TokenBucket:
+        key = self._credential_key()
+        with self._buckets_lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.api_rate, self.api_burst)
+            return self._buckets[key]
+
+    @classmethod
+    def _is_rate_limited(cls, error: HttpError) -> bool:
+        status = getattr(error.resp, "status", None)
+        if status == 429:
+            return True
+        if status != 403:
+            return False
+        try:
+            details = json.loads(error.content.decode("utf-8")).get("error", {})
+        except (ValueError, AttributeError):
+            return False
+        reasons = {e.get("reason") for e in details.get("errors", [])}
+        return bool(reasons & cls.RATE_LIMIT_REASONS)
+
+    @staticmethod
+    def _retry_after(error: HttpError) -> Optional[float]:
+        try:
+            return float(error.resp.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
+    def _execute(self, make_request: Callable[[], Any], label: str) -> Any:
+        """Run a Google API request under the credential's token bucket with rate-limit backoff."""
+        bucket = self._bucket()
+        for attempt in range(self.api_max_retries + 1):
+            if not bucket.acquire(timeout=self.api_acquire_timeout):
+                raise CalendarAPIError(
+                    f"Google Calendar {label} is throttled locally; try again shortly",
+                    status=429,
+                    rate_limited=True,
+                )
+            try:
+                return make_request().execute()
+            except HttpError as error:
+                status = getattr(error.resp, "status", None)
+                if not self._is_rate_limited(error):
+                    raise CalendarAPIError(f"Google Calendar {label} failed: {error}", status=status) from error
+                if attempt == self.api_max_retries:
+                    raise CalendarAPIError(
+                        f"Google Calendar {label} rate limited after {attempt + 1} attempts",
+                        status=status,
+                        rate_limited=True,
+                    ) from error
+                bucket.penalize(backoff_delay(attempt, retry_after=self._retry_after(error)))
+
     # ---------------------- Calendar operations ---------------------- #
-    def get_busy_times(self, start_time: datetime, end_time: datetime) -> List[Dict[str, Any]]:
-        """Get busy time slots from Google Calendar."""
+    @profiled("calendar.get_busy_times")
+    def get_busy_times(
+        self, start_time: datetime, end_time: datetime, deadline: Optional[Deadline] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Get busy time slots from Google Calendar.
+        Overlapping concurrent queries share one freeBusy call; raises CalendarAPIError on failure.
+        With a deadline, waits at most the remaining budget before using last known busy intervals,
+        and at most the hard limit when nothing cached covers the window.
+        """
         if not self.is_authenticated():
             return []
 
         # Localize inputs, then convert to UTC for API
-        start_local = self._localize_naive(start_time)
-        end_local = self._localize_naive(end_time)
-        time_min = self._iso_utc_z(self._to_utc(start_local))
-        time_max = self._iso_utc_z(self._to_utc(end_local))
+        start_utc = self._to_utc(self._localize_naive(start_time))
+        end_utc = self._to_utc(self._localize_naive(end_time))
+        key = self._credential_key()
+
+        @profiled("calendar.freebusy_fetch")
+        def fetch() -> List[Dict[str, Any]]:
+            return self._freebusy_flights.do(
+                (key, "primary"), start_utc, end_utc, self._fetch_busy, self._clip_busy
+            )
+
+        if deadline is None:
+            return sorted(fetch(), key=lambda b: b["start"])
 
+        cached = self._cached_busy(key, start_utc, end_utc)
+        if cached is not None and not deadline.has(self.calendar_min_budget):
+            deadline.degrade("stale_busy")
+            return cached
+
+        # Run in our own pool so we can stop waiting; the call still completes and refreshes the cache.
+        # The copied context lets profiled() attach a sampler to the pool thread.
+        future = self._executor.submit(contextvars.copy_context().run, fetch)
         try:
-            body = {
-                "timeMin": time_min,
-                "timeMax": time_max,
-                "timeZone": "UTC",
-                "items": [{"id": "primary"}],
-            }
-            result = self.service.freebusy().query(body=body).execute()
-            return result.get("calendars", {}).get("primary", {}).get("busy", [])
-        except HttpError as error:
-            print(f"An error occurred: {error}")
-            return []
+            if cached is not None:
+                return sorted(future.result(timeout=deadline.remaining()), key=lambda b: b["start"])
+            return sorted(future.result(timeout=deadline.hard_remaining()), key=lambda b: b["start"])
+        except FutureTimeoutError:
+            if cached is not None:
+                deadline.degrade("stale_busy")
+                return cached
+            raise CalendarAPIError("Google Calendar freeBusy timed out")
+
+    def _cached_busy(self, key: str, start_utc: datetime, end_utc: datetime) -> Optional[List[Dict[str, Any]]]:
+        """
+        Recent busy intervals from a fetched window covering [start_utc, end_utc], if any.
+        Events we booked since are merged in, so a cached read never shows them as free.
+        """
+        with self._busy_cache_lock:
+            entries = list(self._busy_cache.get(key, []))
+            bookings = list(self._recent_bookings.get(key, []))
+        oldest = monotonic() - self.stale_busy_max_age
+        for fetched_at, cached_start, cached_end, busy in reversed(entries):
+            if fetched_at >= oldest and cached_start <= start_utc and cached_end >= end_utc:
+                booked = [
+                    {"start": self._iso_utc_z(b_start), "end": self._iso_utc_z(b_end)}
+                    for booked_at, b_start, b_end in bookings
+                    if booked_at >= fetched_at
+                ]
+                return sorted(self._clip_busy(busy + booked, start_utc, end_utc), key=lambda b: b["start"])
+        return None
+
+    def _record_booking(self, start_utc: datetime, end_utc: datetime):
+        """Remember an event we just created so stale busy reads include it."""
+        now = monotonic()
+        with self._busy_cache_lock:
+            bookings = self._recent_bookings.setdefault(self._credential_key(), [])
+            bookings.append((now, start_utc, end_utc))
+            bookings[:] = [b for b in bookings if b[0] >= now - self.stale_busy_max_age]
+
+    def _fetch_busy(self, start_utc: datetime, end_utc: datetime) -> List[Dict[str, Any]]:
+        body = {
+            "timeMin": self._iso_utc_z(start_utc),
+            "timeMax": self._iso_utc_z(end_utc),
+            "timeZone": "UTC",
+            "items": [{"id": "primary"}],
+        }
+        # Bookings made after this point may be missing from the result; see _cached_busy
+        requested_at = monotonic()
+        result = self._execute(lambda: self.service.freebusy().query(body=body), "freeBusy")
+        calendar = result.get("calendars", {}).get("primary", {})
+        if calendar.get("errors"):
+            raise CalendarAPIError(f"Google Calendar freeBusy failed: {calendar['errors']}")
+        busy = calendar.get("busy", [])
+
+        with self._busy_cache_lock:
+            entries = self._busy_cache.setdefault(self._credential_key(), [])
+            entries.append((requested_at, start_utc, end_utc, busy))
+            del entries[:-8]
+        return busy
+
+    def _clip_busy(self, busy: List[Dict[str, Any]], start_utc: datetime, end_utc: datetime) -> List[Dict[str, Any]]:
+        """Trim a shared freeBusy result to a narrower window, as Google would have."""
+        clipped = []
+        for (b_start, b_end) in self._parse_busy(busy):
+            if b_end <= start_utc or b_start >= end_utc:
+                continue
+            clipped.append({
+                "start": self._iso_utc_z(max(b_start, start_utc)),
+                "end": self._iso_utc_z(min(b_end, end_utc)),
+            })
+        return clipped
 
     def _parse_busy(self, busy: List[Dict[str, str]]) -> List[Tuple[datetime, datetime]]:
         """Parse busy ranges (strings with Z) into UTC-aware datetimes."""
@@ -154,6 +333,66 @@ class CalendarService:
             ranges.append((b_start, b_end))
         return ranges
 
+    def _free_slots_in_day(
+        self,
+        cur_day,
+        time_range_start: str,
+        time_range_end: str,
+        lower: datetime,
+        upper: datetime,
+        busy_ranges: List[Tuple[datetime, datetime]],
+        duration_minutes: int,
+    ) -> List[Tuple[datetime, datetime]]:
+        """Free (start, end) local slots on one day inside a HH:MM window, clamped to [lower, upper]."""
+        # Day window in LOCAL tz, clamped to overall local range
+        day_start_local, day_end_local = self._day_window(
+            cur_day, time_range_start, time_range_end, lower, upper
+        )
+
+        step = timedelta(minutes=30)
+        slot_len = timedelta(minutes=duration_minutes)
+        free_slots: List[Tuple[datetime, datetime]] = []
+
+        current_local = day_start_local
+        while current_local + slot_len <= day_end_local:
+            slot_end_local = current_local + slot_len
+
+            # Compare in UTC
+            current_utc = current_local.astimezone(timezone.utc)
+            slot_end_utc = slot_end_local.astimezone(timezone.utc)
+
+            free = True
+            for b_start_utc, b_end_utc in busy_ranges:
+                if not (slot_end_utc <= b_start_utc or current_utc >= b_end_utc):
+                    free = False
+                    break
+
+            if free:
+                free_slots.append((current_local, slot_end_local))
+
+            current_local += step
+
+        return free_slots
+
+    def _day_window(self, cur_day, time_range_start: str, time_range_end: str,
+                    lower: datetime, upper: datetime) -> Tuple[datetime, datetime]:
+        start_hour, start_minute = map(int, time_range_start.split(":"))
+        end_hour, end_minute = map(int, time_range_end.split(":"))
+        window_start = datetime.combine(cur_day, time(start_hour, start_minute, tzinfo=self.USER_TZ))
+        window_end = datetime.combine(cur_day, time(end_hour, end_minute, tzinfo=self.USER_TZ))
+        return max(window_start, lower), min(window_end, upper)
+
+    def _slot_dict(self, start_local: datetime, end_local: datetime, duration_minutes: int) -> Dict[str, Any]:
+        return {
+            "start": self._iso_utc_z(start_local),
+            "end": self._iso_utc_z(end_local),
+            "duration_minutes": duration_minutes,
+            # Display for humans in local tz:
+            "formatted_start": start_local.strftime("%A, %B %d at %I:%M %p"),
+            "formatted_end": end_local.strftime("%I:%M %p"),
+        }
+
+    @profiled("calendar.find_available_slots")
     def find_available_slots(
         self,
         duration_minutes: int,
@@ -161,10 +400,20 @@ class CalendarService:
         end_date: datetime,
         time_range_start: str = "09:00",
         time_range_end: str = "17:00",
+        alternatives: int = 0,
+        horizon_days: int = 7,
+        deadline: Optional[Deadline] = None,
     ) -> List[Dict[str, Any]]:
         """
         Find available slots using LOCAL working hours in user_tz.
         Returns up to 10 slots. Output 'start'/'end' are RFC3339 UTC strings; formatted fields are in user_tz.
+
+        With alternatives > 0, busy times are fetched once for a wider horizon: up to six days before
+        the preferred window (never before now) through `horizon_days` after it.
+        If the preferred window has no free slot, up to `alternatives` non-overlapping slots are
+        returned instead, nearest first: adjacent hours, then neighboring days, then the following week.
+        Free in-window slots that only the workday-aligned grid hits are kept as 'preferred'.
+        Every slot then carries 'match' and 'distance_minutes' (see _distance_to_windows).
         """
         if not self.is_authenticated():
             return []
@@ -173,81 +422,132 @@ class CalendarService:
         start_local = self._localize_naive(start_date).astimezone(self.USER_TZ)
         end_local = self._localize_naive(end_date).astimezone(self.USER_TZ)
 
-        # Fetch busy in UTC covering the UTC span
-        busy_ranges = self._parse_busy(self.get_busy_times(start_local, end_local))
+        if alternatives <= 0:
+            # Fetch busy in UTC covering the UTC span
+            busy_ranges = self._parse_busy(self.get_busy_times(start_local, end_local, deadline))
+            available: List[Dict[str, Any]] = []
+            cur_day = start_local.date()
+            while cur_day <= end_local.date():
+                for slot_start, slot_end in self._free_slots_in_day(
+                    cur_day, time_range_start, time_range_end,
+                    start_local, end_local, busy_ranges, duration_minutes,
+                ):
+                    available.append(self._slot_dict(slot_start, slot_end, duration_minutes))
+                cur_day += timedelta(days=1)
+            return available[:10]
 
-        available: List[Dict[str, Any]] = []
-
-        start_hour, start_minute = map(int, time_range_start.split(":"))
-        end_hour, end_minute = map(int, time_range_end.split(":"))
+        # One fetch for the whole alternatives horizon; looking back six days keeps every
+        # earlier candidate a "neighboring_day" (day offset < 7)
+        now_local = datetime.now(self.USER_TZ)
+        horizon_start = max(start_local - timedelta(days=6), min(now_local, start_local))
+        horizon_end = end_local + timedelta(days=horizon_days)
+        busy_ranges = self._parse_busy(self.get_busy_times(horizon_start, horizon_end, deadline))
 
+        preferred_windows: List[Tuple[datetime, datetime]] = []
+        preferred: List[Dict[str, Any]] = []
         cur_day = start_local.date()
-        last_day = end_local.date()
-
-        step = timedelta(minutes=30)
-        slot_len = timedelta(minutes=duration_minutes)
-
-        while cur_day <= last_day:
-            # Day window in LOCAL tz
-            day_start_local = datetime.combine(
-                cur_day, time(start_hour, start_minute, tzinfo=self.USER_TZ)
-            )
-            day_end_local = datetime.combine(
-                cur_day, time(end_hour, end_minute, tzinfo=self.USER_TZ)
+        while cur_day <= end_local.date():
+            window_start, window_end = self._day_window(
+                cur_day, time_range_start, time_range_end, start_local, end_local
             )
+            if window_start < window_end:
+                preferred_windows.append((window_start, window_end))
+            for slot_start, slot_end in self._free_slots_in_day(
+                cur_day, time_range_start, time_range_end,
+                start_local, end_local, busy_ranges, duration_minutes,
+            ):
+                preferred.append({
+                    **self._slot_dict(slot_start, slot_end, duration_minutes),
+                    "match": "preferred",
+                    "distance_minutes": 0,
+                })
+            cur_day += timedelta(days=1)
 
-            # Clamp to overall local range
-            if day_start_local < start_local:
-                day_start_local = start_local
-            if day_end_local > end_local:
-                day_end_local = end_local
+        if preferred or not preferred_windows:
+            return preferred[:10]
+
+        # Widen the day to working hours (never narrower than the preferred range)
+        day_start = min(self.workday_start, time_range_start)
+        day_end = max(self.workday_end, time_range_end)
+
+        candidates: List[Tuple[int, str, datetime, datetime]] = []
+        cur_day = horizon_start.date()
+        while cur_day <= horizon_end.date():
+            for slot_start, slot_end in self._free_slots_in_day(
+                cur_day, day_start, day_end, horizon_start, horizon_end, busy_ranges, duration_minutes,
+            ):
+                distance, day_offset = self._distance_to_windows(slot_start, slot_end, preferred_windows)
+                if distance == 0:
+                    # In the window but off the preferred pass's grid (it steps from the window start)
+                    match = "preferred"
+                elif day_offset == 0:
+                    match = "adjacent_hours"
+                elif day_offset < 7:
+                    match = "neighboring_day"
+                else:
+                    match = "following_week"
+                candidates.append((distance, match, slot_start, slot_end))
+            cur_day += timedelta(days=1)
 
-            if day_start_local >= day_end_local:
-                cur_day += timedelta(days=1)
+        candidates.sort(key=lambda c: (c[0], c[2]))
+        chosen: List[Tuple[int, str, datetime, datetime]] = []
+        for candidate in candidates:
+            if len(chosen) >= alternatives:
+                break
+            # Offer distinct options rather than the same hour shifted by 30 minutes
+            if any(candidate[2] < c[3] and c[2] < candidate[3] for c in chosen):
                 continue
+            chosen.append(candidate)
 
-            current_local = day_start_local
-            while current_local + slot_len <= day_end_local:
-                slot_end_local = current_local + slot_len
-
-                # Compare in UTC
-                current_utc = current_local.astimezone(timezone.utc)
-                slot_end_utc = slot_end_local.astimezone(timezone.utc)
-
-                free = True
-                for b_start_utc, b_end_utc in busy_ranges:
-                    if not (slot_end_utc <= b_start_utc or current_utc >= b_end_utc):
-                        free = False
-                        break
-
-                if free:
-                    available.append(
-                        {
-                            "start": self._iso_utc_z(current_utc),
-                            "end": self._iso_utc_z(slot_end_utc),
-                            "duration_minutes": duration_minutes,
-                            # Display for humans in local tz:
-                            "formatted_start": current_local.strftime("%A, %B %d at %I:%M %p"),
-                            "formatted_end": slot_end_local.strftime("%I:%M %p"),
-                        }
-                    )
-
-                current_local += step
-
-            cur_day += timedelta(days=1)
-
-        return available[:10]
+        return [
+            {
+                **self._slot_dict(slot_start, slot_end, duration_minutes),
+                "match": match,
+                "distance_minutes": distance,
+            }
+            for distance, match, slot_start, slot_end in chosen
+        ]
 
+    @staticmethod
+    def _distance_to_windows(
+        slot_start: datetime, slot_end: datetime, windows: List[Tuple[datetime, datetime]]
+    ) -> Tuple[int, int]:
+        """
+        Distance from a slot to the nearest preferred window, as
+        day_offset * 1440 + minutes the slot pokes out of the window's hours.
+        So a shifted hour on the same day beats the same hour on a neighboring
+        day, which beats anything in the following week. Returns (distance, day_offset).
+        """
+        def minute_of_day(dt: datetime) -> int:
+            return dt.hour * 60 + dt.minute
+
+        slot_from = minute_of_day(slot_start)
+        slot_to = slot_from + int((slot_end - slot_start).total_seconds() // 60)
+        best: Optional[Tuple[int, int]] = None
+        for window_start, window_end in windows:
+            day_offset = abs((slot_start.date() - window_start.date()).days)
+            window_from = minute_of_day(window_start)
+            window_to = window_from + int((window_end - window_start).total_seconds() // 60)
+            overhang = max(0, window_from - slot_from, slot_to - window_to)
+            distance = day_offset * 1440 + overhang
+            if best is None or distance < best[0]:
+                best = (distance, day_offset)
+        return best
+
+    @profiled("calendar.create_event")
     def create_event(
         self,
         summary: str,
         start_time: datetime,
         end_time: datetime,
         description: Optional[str] = None,
+        deadline: Optional[Deadline] = None,
     ) -> Dict[str, Any]:
         """
         Create an event at the intended LOCAL time (user_tz). We send dateTime in local tz + timeZone=user_tz
         so Google renders exactly what the user picked.
+        With a deadline, waits at most the hard limit; the result is then marked 'unconfirmed'
+        because the insert may still land.
         """
         if not self.is_authenticated():
             raise Exception("Not authenticated with Google Calendar")
@@ -262,13 +562,34 @@ class CalendarService:
             "end": {"dateTime": end_local.isoformat(), "timeZone": self.user_tz_name},
         }
 
+        @profiled("calendar.event_insert")
+        def insert() -> Dict[str, Any]:
+            created = self._execute(
+                lambda: self.service.events().insert(calendarId="primary", body=event), "event insert"
+            )
+            self._record_booking(self._to_utc(start_local), self._to_utc(end_local))
+            return created
+
         try:
-            created = self.service.events().insert(calendarId="primary", body=event).execute()
+            if deadline is None:
+                created = insert()
+            else:
+                # Same pattern as get_busy_times: stop waiting at the hard limit, let the insert finish
+                future = self._executor.submit(contextvars.copy_context().run, insert)
+                try:
+                    created = future.result(timeout=deadline.hard_remaining())
+                except FutureTimeoutError:
+                    print("Event insert did not finish before the turn's hard limit")
+                    return {
+                        "success": False,
+                        "unconfirmed": True,
+                        "error": "Google Calendar did not confirm the booking in time; it may still appear",
+                    }
             return {
                 "success": True,
                 "event_id": created.get("id"),
                 "html_link": created.get("htmlLink"),
             }
-        except HttpError as error:
+        except CalendarAPIError as error:
             print(f"An error occurred: {error}")
-            return {"success": False, "error": str(error)}
+            return {"success": False, "error": str(error), "rate_limited": error.rate_limited}
@@ -2,21 +2,34 @@ import os
 from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
 import json
-from openai import OpenAI
+import asyncio
+from openai import OpenAI, APIError
 from dateutil import parser
 from dateutil.relativedelta import relativedelta
 import re
-from models.schemas import ConversationState, Message, MessageRole
+import time
+import uuid
+from models.schemas import ConversationState, Message, MessageRole, RoutingDecision
 from openai import AsyncOpenAI
+from services.model_router import ModelRouter
+from services.calendar_service import CalendarAPIError
+from services.deadline import Deadline
+from services.profiler import profiled
 
 
 class ConversationService:
-    def __init__(self, calendar_service):
+    def __init__(self, calendar_service, client_id: Optional[str] = None):
         self.calendar_service = calendar_service
+        self.client_id = client_id
         self.client = OpenAI(
         api_key= os.getenv("OPENAI_API_KEY"),
         base_url= 'https://truefoundry.innovaccer.com/api/llm/api/inference/openai/'
 )
+        self.router = ModelRouter(client_id=client_id, conversation_id=uuid.uuid4().hex)
+        self.turn_id = 0
+        self.alternatives_count = int(os.getenv("ALTERNATIVES_COUNT", "3"))
+        self.verbalize_min_budget = float(os.getenv("VERBALIZE_MIN_BUDGET_MS", "1500")) / 1000
+        self.llm_retry_min_budget = float(os.getenv("LLM_RETRY_MIN_BUDGET_MS", "3000")) / 1000
         self.conversation_history: List[Dict[str, str]] = []
         self.state = ConversationState()
         
@@ -38,6 +51,8 @@ Guidelines:
 - Be proactive in offering solutions
 
 When you have enough information to search for slots, use the search_calendar function.
+If search_calendar returns no available_slots but lists alternatives, offer the closest alternatives
+(they are ordered nearest first) instead of searching again.
 When the user confirms a time slot, use the create_event function.
 """
         
@@ -171,7 +186,8 @@ When the user confirms a time slot, use the create_event function.
         }
     
     def search_calendar(self, duration_minutes: int, preferred_day: Optional[str] = None, 
-                       time_of_day: Optional[str] = None, days_ahead: int = 7) -> Dict[str, Any]:
+                       time_of_day: Optional[str] = None, days_ahead: int = 7,
+                       deadline: Optional[Deadline] = None) -> Dict[str, Any]:
         """Search for available calendar slots"""
         self.state.duration_minutes = duration_minutes
         
@@ -180,26 +196,50 @@ When the user confirms a time slot, use the create_event function.
         if not preferred_day:
             time_prefs["end_date"] = time_prefs["start_date"] + timedelta(days=days_ahead)
         
-        available_slots = self.calendar_service.find_available_slots(
-            duration_minutes=duration_minutes,
-            start_date=time_prefs["start_date"],
-            end_date=time_prefs["end_date"],
-            time_range_start=time_prefs["time_range_start"],
-            time_range_end=time_prefs["time_range_end"]
-        )
+        search_criteria = {
+            "duration_minutes": duration_minutes,
+            "preferred_day": preferred_day,
+            "time_of_day": time_of_day
+        }
         
-        return {
+        try:
+            slots = self.calendar_service.find_available_slots(
+                duration_minutes=duration_minutes,
+                start_date=time_prefs["start_date"],
+                end_date=time_prefs["end_date"],
+                time_range_start=time_prefs["time_range_start"],
+                time_range_end=time_prefs["time_range_end"],
+                alternatives=self.alternatives_count,
+                deadline=deadline
+            )
+        except CalendarAPIError as error:
+            # Never report an unknown calendar as free; let the model say we couldn't check
+            return {
+                "available_slots": [],
+                "total_found": 0,
+                "error": str(error),
+                "rate_limited": error.rate_limited,
+                "alternatives": [],
+                "search_criteria": search_criteria
+            }
+        
+        available_slots = [slot for slot in slots if slot.get("match", "preferred") == "preferred"]
+        alternatives = [slot for slot in slots if slot.get("match", "preferred") != "preferred"]
+        
+        result = {
             "available_slots": available_slots,
             "total_found": len(available_slots),
-            "search_criteria": {
-                "duration_minutes": duration_minutes,
-                "preferred_day": preferred_day,
-                "time_of_day": time_of_day
-            }
+            "alternatives": alternatives,
+            "search_criteria": search_criteria
         }
+        if deadline is not None and "stale_busy" in deadline.degradations:
+            result["busy_data_stale"] = True
+            result["note"] = ("Calendar data is from a cached read a few minutes old; "
+                              "tell the user availability may have changed since.")
+        return result
     
     def create_event(self, start_time: str, duration_minutes: int, 
-                    title: str, description: str = "") -> Dict[str, Any]:
+                    title: str, description: str = "", deadline: Optional[Deadline] = None) -> Dict[str, Any]:
         """Create a calendar event"""
         start_dt = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
         end_dt = start_dt + timedelta(minutes=duration_minutes)
@@ -208,34 +248,150 @@ When the user confirms a time slot, use the create_event function.
             summary=title,
             start_time=start_dt,
             end_time=end_dt,
-            description=description
+            description=description,
+            deadline=deadline
         )
         
         return result
     
-    async def process_message(self, user_message: str) -> Dict[str, Any]:
-        """Process user message and generate response using OpenAI"""
+    async def _chat_completion(self, decision: RoutingDecision, purpose: str,
+                               messages: List[Dict[str, Any]], timeout: Optional[float] = None, **kwargs):
+        """Run one chat completion on the routed model and record it; raises asyncio.TimeoutError past `timeout`"""
+        # wait_for enforces the budget, but the worker thread only frees up once the SDK gives up,
+        # so the SDK gets the same timeout; its retries stay on unless there is no time left for one
+        client = self.client
+        if timeout is not None:
+            options = {"timeout": max(timeout, 0.001)}
+            if timeout < self.llm_retry_min_budget:
+                options["max_retries"] = 0
+            client = self.client.with_options(**options)
+        
+        started = time.perf_counter()
+        response = await asyncio.wait_for(
+            # profiled() attaches a sampler to the worker thread when the turn is being profiled
+            asyncio.to_thread(
+                profiled(f"llm.{purpose}")(client.chat.completions.create),
+                model=decision.model,
+                messages=messages,
+                **kwargs
+            ),
+            timeout=timeout
+        )
+        self.router.record(
+            decision,
+            purpose,
+            (time.perf_counter() - started) * 1000,
+            getattr(response, "usage", None),
+            turn_id=self.turn_id
+        )
+        return response
+    
+    def _first_tool_argument_error(self, tool_calls) -> Optional[str]:
+        """Return the first schema violation among the model's tool calls, if any"""
+        for tool_call in tool_calls:
+            error = ModelRouter.validate_tool_arguments(
+                self.tools, tool_call.function.name, tool_call.function.arguments
+            )
+            if error:
+                return error
+        return None
+    
+    def _build_messages(self) -> List[Dict[str, Any]]:
+        """
+        Messages laid out for upstream prefix caching: the fixed system prompt and
+        append-only history form a byte-stable prefix across turns, and volatile
+        context (the current date) goes at the tail so it never invalidates it.
+        """
+        now = datetime.now(self.calendar_service.USER_TZ)
+        context = {
+            "role": "system",
+            "content": f"Current date and time: {now.strftime('%A, %B %d, %Y %I:%M %p')} ({self.calendar_service.user_tz_name})"
+        }
+        return [{"role": "system", "content": self.system_prompt}] + self.conversation_history + [context]
+    
+    async def _verbalize(self, function_name: str, result: Dict[str, Any], deadline: Deadline) -> str:
+        """
+        Turn a tool result into a reply, falling back to a template when the budget runs short
+        or the completion fails (the tool already ran, so an error reply would invite a duplicate booking)
+        """
+        if deadline.has(self.verbalize_min_budget):
+            try:
+                second_response = await self._chat_completion(
+                    self.router.route_verbalization(),
+                    "verbalization",
+                    self._build_messages(),
+                    timeout=deadline.remaining(),
+                    # Same tools as the turn call so the cached prefix matches; none may be called
+                    tools=self.tools,
+                    tool_choice="none"
+                )
+                return second_response.choices[0].message.content
+            except asyncio.TimeoutError:
+                pass
+            except APIError as e:
+                print(f"Verbalization failed, using template reply: {str(e)}")
+        
+        deadline.degrade("template_reply")
+        return self._template_reply(function_name, result)
+    
+    @staticmethod
+    def _template_reply(function_name: str, result: Dict[str, Any]) -> str:
+        """Short spoken reply built directly from a tool result"""
+        if function_name == "create_event":
+            if result.get("success"):
+                return "Done, your meeting is booked."
+            if result.get("unconfirmed"):
+                return ("Google Calendar hasn't confirmed the booking yet. "
+                        "Please check your calendar before asking me to book it again.")
+            return f"I wasn't able to book that: {result.get('error', 'unknown error')}."
+        
+        if result.get("error"):
+            return "I couldn't check your calendar just now. Could you try again in a moment?"
+        stale = " That's from a cached look at your calendar, so it may have changed." \
+            if result.get("busy_data_stale") else ""
+        slots = result.get("available_slots", [])
+        if slots:
+            return (f"I found {len(slots)} open slot{'s' if len(slots) != 1 else ''}. "
+                    f"The first one is {slots[0]['formatted_start']}.{stale} Does that work?")
+        alternatives = result.get("alternatives", [])
+        if alternatives:
+            return (f"That time is booked. The closest opening is {alternatives[0]['formatted_start']}.{stale} "
+                    "Would that work?")
+        return f"I couldn't find any open slots for that.{stale} Would another day or time work?"
+    
+    async def process_message(self, user_message: str, deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        """Process user message and generate response using OpenAI, within the turn's deadline"""
+        deadline = deadline or Deadline.from_env()
+        self.turn_id += 1
         
         self.conversation_history.append({
             "role": "user",
             "content": user_message
         })
         
-        messages = [
-            {"role": "system", "content": self.system_prompt}
-        ] + self.conversation_history
+        messages = self._build_messages()
         
         try:
-            response = self.client.chat.completions.create(
-                model="openai/gpt-4o",
-                messages=messages,
-                tools=self.tools,
-                tool_choice="auto"
+            decision = self.router.route_turn(user_message)
+            response = await self._chat_completion(
+                decision, "turn", messages, timeout=deadline.hard_remaining(),
+                tools=self.tools, tool_choice="auto"
             )
             
             response_message = response.choices[0].message
             tool_calls = response_message.tool_calls
             
+            if tool_calls and decision.tier == ModelRouter.FAST:
+                validation_error = self._first_tool_argument_error(tool_calls)
+                if validation_error:
+                    decision = self.router.escalate(f"tool_argument_validation_failed:{validation_error}")
+                    response = await self._chat_completion(
+                        decision, "turn", messages, timeout=deadline.hard_remaining(),
+                        tools=self.tools, tool_choice="auto"
+                    )
+                    response_message = response.choices[0].message
+                    tool_calls = response_message.tool_calls
+            
             available_slots = []
             
             if tool_calls:
@@ -244,8 +400,8 @@ When the user confirms a time slot, use the create_event function.
                     function_args = json.loads(tool_call.function.arguments)
                     
                     if function_name == "search_calendar":
-                        result = self.search_calendar(**function_args)
-                        available_slots = result["available_slots"]
+                        result = await asyncio.to_thread(self.search_calendar, deadline=deadline, **function_args)
+                        available_slots = result["available_slots"] or result["alternatives"]
                         
                         self.conversation_history.append({
                             "role": "assistant",
@@ -259,17 +415,10 @@ When the user confirms a time slot, use the create_event function.
                             "content": json.dumps(result)
                         })
                         
-                        second_response = self.client.chat.completions.create(
-                            model="openai/gpt-4o",
-                            messages=[
-                                {"role": "system", "content": self.system_prompt}
-                            ] + self.conversation_history
-                        )
-                        
-                        final_message = second_response.choices[0].message.content
+                        final_message = await self._verbalize(function_name, result, deadline)
                         
                     elif function_name == "create_event":
-                        result = self.create_event(**function_args)
+                        result = await asyncio.to_thread(self.create_event, deadline=deadline, **function_args)
                         
                         self.conversation_history.append({
                             "role": "assistant",
@@ -283,14 +432,7 @@ When the user confirms a time slot, use the create_event function.
                             "content": json.dumps(result)
                         })
                         
-                        second_response = self.client.chat.completions.create(
-                            model="openai/gpt-4o",
-                            messages=[
-                                {"role": "system", "content": self.system_prompt}
-                            ] + self.conversation_history
-                        )
-                        
-                        final_message = second_response.choices[0].message.content
+                        final_message = await self._verbalize(function_name, result, deadline)
                 
                 self.conversation_history.append({
                     "role": "assistant",
@@ -300,7 +442,8 @@ When the user confirms a time slot, use the create_event function.
                 return {
                     "message": final_message,
                     "available_slots": available_slots,
-                    "state": self.state.model_dump()
+                    "state": self.state.model_dump(),
+                    "degraded": deadline.degradations
                 }
             
             else:
@@ -314,17 +457,30 @@ When the user confirms a time slot, use the create_event function.
                 return {
                     "message": assistant_message,
                     "available_slots": available_slots,
-                    "state": self.state.model_dump()
+                    "state": self.state.model_dump(),
+                    "degraded": deadline.degradations
                 }
         
+        except asyncio.TimeoutError:
+            deadline.degrade("hard_limit")
+            return {
+                "message": "Sorry, that took too long on my end. Could you please try again?",
+                "available_slots": [],
+                "state": self.state.model_dump(),
+                "degraded": deadline.degradations
+            }
+        
         except Exception as e:
             return {
                 "message": f"I encountered an error: {str(e)}. Could you please try again?",
                 "available_slots": [],
-                "state": self.state.model_dump()
+                "state": self.state.model_dump(),
+                "degraded": deadline.degradations
             }
     
     def reset(self):
         """Reset conversation state"""
         self.conversation_history = []
         self.state = ConversationState()
+        self.router.conversation_id = uuid.uuid4().hex
+        self.turn_id = 0
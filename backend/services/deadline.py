@@ -0,0 +1,50 @@
+import os
+import time
+from typing import List, Optional
+
+
+class Deadline:
+    """
+    Time budget for one conversation turn.
+
+    Key ideas:
+    - `budget` is the soft limit: stages check remaining() and degrade in order
+      (last known busy intervals, then a templated reply instead of the second
+      completion) so the turn fits, and when it expires the client gets a
+      "still checking" frame while the turn finishes in the background.
+    - `hard_limit` bounds that background continuation; LLM and Google calls
+      are cut off once it is spent.
+    - Every degradation step taken is recorded so the response can report it.
+    """
+
+    def __init__(self, budget_seconds: float, hard_limit_seconds: Optional[float] = None):
+        self.started = time.monotonic()
+        self.budget = budget_seconds
+        self.hard_limit = max(hard_limit_seconds or budget_seconds, budget_seconds)
+        self.degradations: List[str] = []
+
+    @classmethod
+    def from_env(cls) -> "Deadline":
+        return cls(
+            float(os.getenv("TURN_BUDGET_MS", "5000")) / 1000,
+            float(os.getenv("TURN_HARD_LIMIT_MS", "30000")) / 1000,
+        )
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining(self) -> float:
+        """Seconds left in the soft budget."""
+        return max(self.budget - self.elapsed(), 0.0)
+
+    def hard_remaining(self) -> float:
+        """Seconds left before work on this turn is abandoned."""
+        return max(self.hard_limit - self.elapsed(), 0.0)
+
+    def has(self, seconds: float) -> bool:
+        return self.remaining() >= seconds
+
+    def degrade(self, step: str):
+        if step not in self.degradations:
+            print(f"Turn degraded after {self.elapsed() * 1000:.0f}ms: {step}")
+            self.degradations.append(step)
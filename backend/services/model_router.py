@@ -0,0 +1,173 @@
+import os
+import re
+import json
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from models.schemas import ModelCallRecord, RoutingDecision
+
+
+class ModelRouter:
+    """
+    Picks a model tier for each chat completion.
+
+    Key ideas:
+    - Simple turns and post-tool verbalization go to the fast tier.
+    - Ambiguous requests, or ones with several extra constraints (exclusions,
+      before/after bounds, buffers), escalate to the large tier up front.
+    - Tool-argument validation failures on the fast tier escalate and retry.
+    - Every call is recorded (model, reason, latency, usage incl. cached prompt tokens) for offline replay.
+    """
+    FAST = "fast"
+    LARGE = "large"
+
+    AMBIGUITY_PATTERN = re.compile(
+        r"\b(maybe|perhaps|not sure|either|or so|sometime|whenever|flexible|depends|"
+        r"whichever|somewhere|any time|anytime|unless)\b|\?.*\?"
+    )
+
+    # Basic scheduling facts every request carries; they never escalate on their own
+    BASIC_PATTERNS = [
+        re.compile(r"\b(monday|tuesday|wednesday|thursday|friday|saturday|sunday|today|tomorrow|next week)\b"),
+        re.compile(r"\b(morning|afternoon|evening|noon|\d{1,2}(:\d{2})?\s*(am|pm))\b"),
+        re.compile(r"\b\d+\s*(min|mins|minute|minutes|hour|hours|hr|hrs)\b|\bhalf an hour\b"),
+    ]
+
+    # Each pattern counts as one extra constraint toward escalation
+    CONSTRAINT_PATTERNS = [
+        re.compile(r"\b(before|after|between|no later than|no earlier than)\b"),
+        re.compile(r"\b(not|except|avoid|but|without|other than)\b"),
+        re.compile(r"\b(buffer|back[- ]to[- ]back|break|gap)\b"),
+    ]
+
+    def __init__(
+        self,
+        fast_model: Optional[str] = None,
+        large_model: Optional[str] = None,
+        multi_constraint_threshold: Optional[int] = None,
+        log_path: Optional[str] = None,
+        client_id: Optional[str] = None,
+        conversation_id: Optional[str] = None,
+    ):
+        self.tiers = {
+            self.FAST: fast_model or os.getenv("FAST_MODEL", "openai/gpt-4o-mini"),
+            self.LARGE: large_model or os.getenv("LARGE_MODEL", "openai/gpt-4o"),
+        }
+        self.multi_constraint_threshold = multi_constraint_threshold or int(
+            os.getenv("MULTI_CONSTRAINT_THRESHOLD", "2")
+        )
+        self.log_path = log_path if log_path is not None else os.getenv("MODEL_CALL_LOG", "model_calls.jsonl")
+        self.client_id = client_id
+        self.conversation_id = conversation_id
+
+    # ---------------------- Routing ---------------------- #
+    def _decision(self, tier: str, reason: str) -> RoutingDecision:
+        return RoutingDecision(tier=tier, model=self.tiers[tier], reason=reason)
+
+    @staticmethod
+    def _count_matches(patterns: List[re.Pattern], text: str) -> int:
+        text_lower = text.lower()
+        return sum(1 for pattern in patterns if pattern.search(text_lower))
+
+    def count_constraints(self, text: str) -> int:
+        """Extra constraints beyond the basic day / time / duration of a request."""
+        return self._count_matches(self.CONSTRAINT_PATTERNS, text)
+
+    def route_turn(self, user_message: str) -> RoutingDecision:
+        """Choose the tier for the first completion of a user turn."""
+        if self.AMBIGUITY_PATTERN.search(user_message.lower()):
+            return self._decision(self.LARGE, "ambiguity")
+
+        constraints = self.count_constraints(user_message)
+        if constraints >= self.multi_constraint_threshold:
+            basics = self._count_matches(self.BASIC_PATTERNS, user_message)
+            return self._decision(self.LARGE, f"multi_constraint:{constraints}+{basics}_basic")
+
+        return self._decision(self.FAST, "simple_turn")
+
+    def route_verbalization(self) -> RoutingDecision:
+        """Choose the tier for turning a tool result into a spoken sentence."""
+        return self._decision(self.FAST, "post_tool_verbalization")
+
+    def escalate(self, reason: str) -> RoutingDecision:
+        return self._decision(self.LARGE, reason)
+
+    # ---------------------- Tool argument validation ---------------------- #
+    @staticmethod
+    def validate_tool_arguments(tools: List[Dict[str, Any]], name: str, raw_arguments: str) -> Optional[str]:
+        """
+        Check a tool call against its declared JSON schema.
+        Returns a short error string, or None when the arguments are usable.
+        """
+        schema = next(
+            (t["function"]["parameters"] for t in tools if t["function"]["name"] == name),
+            None,
+        )
+        if schema is None:
+            return f"unknown_tool:{name}"
+
+        try:
+            args = json.loads(raw_arguments or "{}")
+        except json.JSONDecodeError:
+            return "invalid_json"
+        if not isinstance(args, dict):
+            return "arguments_not_object"
+
+        properties = schema.get("properties", {})
+        for key in schema.get("required", []):
+            if args.get(key) in (None, ""):
+                return f"missing:{key}"
+
+        for key, value in args.items():
+            if key not in properties:
+                return f"unexpected:{key}"
+            expected = properties[key].get("type")
+            if expected == "integer" and (not isinstance(value, int) or isinstance(value, bool)):
+                return f"type:{key}"
+            if expected == "string" and not isinstance(value, str):
+                return f"type:{key}"
+
+        return None
+
+    # ---------------------- Accounting ---------------------- #
+    def record(
+        self,
+        decision: RoutingDecision,
+        purpose: str,
+        latency_ms: float,
+        usage: Optional[Any] = None,
+        turn_id: Optional[int] = None,
+    ) -> ModelCallRecord:
+        """
+        Build the record for one completion and append it to MODEL_CALL_LOG as a JSON line
+        (printed instead when MODEL_CALL_LOG is empty). Records are not kept in memory;
+        the log is the source for offline replay.
+        """
+        record = ModelCallRecord(
+            timestamp=datetime.now(),
+            client_id=self.client_id,
+            conversation_id=self.conversation_id,
+            turn_id=turn_id,
+            purpose=purpose,
+            tier=decision.tier,
+            model=decision.model,
+            reason=decision.reason,
+            latency_ms=round(latency_ms, 1),
+            prompt_tokens=getattr(usage, "prompt_tokens", None),
+            completion_tokens=getattr(usage, "completion_tokens", None),
+            cached_tokens=getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None),
+        )
+
+        line = record.model_dump_json()
+        if not self.log_path:
+            print(f"Model call: {line}")
+            return record
+
+        try:
+            with open(self.log_path, "a") as log_file:
+                log_file.write(line + "\n")
+        except OSError as error:
+            print(f"Could not write model call log: {error}")
+            print(f"Model call: {line}")
+
+        return record
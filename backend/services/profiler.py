@@ -0,0 +1,262 @@
+import os
+import sys
+import asyncio
+import time
+import random
+import threading
+import functools
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+
+class _Session:
+    """Stacks collected for one profile, possibly from several threads."""
+
+    def __init__(self):
+        self.stacks: Counter = Counter()
+        self.threads = set()
+        self.lock = threading.Lock()
+
+
+_active_session: contextvars.ContextVar = contextvars.ContextVar("profiler_session", default=None)
+
+
+class _Sampler(threading.Thread):
+    """Background thread that periodically snapshots one target thread's stack."""
+
+    def __init__(self, target_ident: int, interval: float, session: _Session, prefix: str = ""):
+        super().__init__(daemon=True)
+        self.target_ident = target_ident
+        self.interval = interval
+        self.session = session
+        self.prefix = prefix
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_ident)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                names.append(self._frame_name(frame))
+                frame = frame.f_back
+            if self.prefix:
+                names.append(self.prefix)
+            with self.session.lock:
+                self.session.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class SamplingProfiler:
+    """
+    Opt-in, low-overhead sampling profiler for live turns.
+
+    Key ideas:
+    - A session is started per request (explicit flag), for the next N turns
+      (admin endpoint), or at random with PROFILE_SAMPLE_RATE. Only the outer
+      per-turn session() samples; profiled() calls join an active session and
+      never start one of their own unless profiling is enabled outright.
+    - While a session is active a daemon thread samples the calling thread's stack
+      every PROFILE_INTERVAL_MS and counts identical stacks.
+    - Output is written as folded stacks (`frame;frame;frame count`), which
+      flamegraph.pl, speedscope and inferno read directly. Only the newest
+      PROFILE_MAX_FILES profiles are kept in PROFILE_DIR.
+    - A turn's event-loop thread is shared with every other session, so its
+      stacks may include other clients' coroutines; they are rooted under
+      `event_loop_shared`. Stacks from the turn's own worker threads are rooted
+      under `thread:<label>` and belong to this turn only.
+    - Outside a session, a wrapped call costs one context-variable lookup; see measure_disabled_overhead().
+    """
+
+    def __init__(
+        self,
+        output_dir: Optional[str] = None,
+        sample_rate: Optional[float] = None,
+        interval_ms: Optional[float] = None,
+    ):
+        self.output_dir = Path(output_dir or os.getenv("PROFILE_DIR", "profiles"))
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+        self.interval = (interval_ms or float(os.getenv("PROFILE_INTERVAL_MS", "5"))) / 1000
+        self.max_files = int(os.getenv("PROFILE_MAX_FILES", "100"))
+        self.enabled = False
+        self.pending_turns = 0
+        self._lock = threading.Lock()
+        self.last_profiles: list = []
+        self._disabled_overhead_ns: Optional[float] = None
+
+    # ---------------------- Control ---------------------- #
+    def configure(
+        self,
+        enabled: Optional[bool] = None,
+        sample_rate: Optional[float] = None,
+        next_turns: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        with self._lock:
+            if enabled is not None:
+                self.enabled = enabled
+            if sample_rate is not None:
+                self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+            if next_turns is not None:
+                self.pending_turns = max(next_turns, 0)
+        return self.status()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "pending_turns": self.pending_turns,
+            "interval_ms": self.interval * 1000,
+            "output_dir": str(self.output_dir),
+            "last_profiles": self.last_profiles[-10:],
+        }
+
+    def _should_profile(self, force: bool) -> bool:
+        if force or self.enabled:
+            return True
+        if self.pending_turns:
+            with self._lock:
+                if self.pending_turns:
+                    self.pending_turns -= 1
+                    return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    # ---------------------- Sessions ---------------------- #
+    @contextmanager
+    def session(self, label: str, force: bool = False):
+        """
+        Profile the enclosed block. Nested sessions are folded into the outer
+        one: on the same thread they are a no-op, and on a worker thread
+        (e.g. via asyncio.to_thread, which copies the context) they add a
+        sampler for that thread to the same profile.
+        """
+        current = _active_session.get()
+        if current is not None:
+            ident = threading.get_ident()
+            if ident in current.threads:
+                yield
+                return
+            with self._sample(ident, current, prefix=f"thread:{label}"):
+                yield
+            return
+
+        if not self._should_profile(force):
+            yield
+            return
+
+        profile = _Session()
+        token = _active_session.set(profile)
+        started = time.perf_counter()
+        try:
+            with self._sample(threading.get_ident(), profile, prefix=self._loop_prefix()):
+                yield
+        finally:
+            _active_session.reset(token)
+            self._write(label, profile.stacks, time.perf_counter() - started)
+
+    @staticmethod
+    def _loop_prefix() -> str:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return ""
+        return "event_loop_shared"
+
+    @contextmanager
+    def _sample(self, ident: int, profile: _Session, prefix: str = ""):
+        sampler = _Sampler(ident, self.interval, profile, prefix)
+        profile.threads.add(ident)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            profile.threads.discard(ident)
+
+    def _write(self, label: str, stacks: Counter, elapsed: float):
+        safe_label = "".join(c if c.isalnum() or c in "-_." else "_" for c in label)
+        path = self.output_dir / f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{safe_label}.folded"
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            with open(path, "w") as out:
+                for stack, count in stacks.most_common():
+                    out.write(f"{stack} {count}\n")
+        except OSError as error:
+            print(f"Could not write profile: {error}")
+            return
+        self.last_profiles.append({
+            "path": str(path),
+            "label": label,
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "samples": sum(stacks.values()),
+        })
+        self.last_profiles = self.last_profiles[-50:]
+        self._rotate()
+
+    def _rotate(self):
+        """Delete the oldest profiles beyond max_files (names sort by timestamp)."""
+        try:
+            profiles = sorted(self.output_dir.glob("*.folded"))
+            for old in profiles[:max(len(profiles) - self.max_files, 0)]:
+                old.unlink(missing_ok=True)
+        except OSError as error:
+            print(f"Could not rotate profiles: {error}")
+
+    def measure_disabled_overhead(self, iterations: int = 100000) -> float:
+        """
+        Nanoseconds added per profiled() call while profiling is off.
+        Measured once on a throwaway idle instance, so live settings are never
+        touched, then cached; it is CPU-bound, so call it off the event loop.
+        """
+        if self._disabled_overhead_ns is not None:
+            return self._disabled_overhead_ns
+
+        probe = SamplingProfiler(output_dir=str(self.output_dir), sample_rate=0.0)
+
+        def noop():
+            return None
+
+        wrapped = probe.wrap("overhead")(noop)
+        started = time.perf_counter_ns()
+        for _ in range(iterations):
+            wrapped()
+        with_wrapper = time.perf_counter_ns() - started
+
+        started = time.perf_counter_ns()
+        for _ in range(iterations):
+            noop()
+        baseline = time.perf_counter_ns() - started
+
+        self._disabled_overhead_ns = max(with_wrapper - baseline, 0) / iterations
+        return self._disabled_overhead_ns
+
+    def wrap(self, label: str):
+        """
+        Decorator that adds the wrapped call to the active profiler session.
+        Without one it runs unprofiled, so stray calls never produce orphan profiles.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if _active_session.get() is None and not self.enabled:
+                    return func(*args, **kwargs)
+                with self.session(label):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+profiler = SamplingProfiler()
+profiled = profiler.wrap
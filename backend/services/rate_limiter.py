@@ -0,0 +1,131 @@
+import time
+import random
+import threading
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Callable, Hashable
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    `rate` tokens are added per second up to `capacity`. A rate-limit response
+    from upstream calls penalize(), which empties the bucket and blocks every
+    caller sharing it until the backoff has elapsed.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Take one token, sleeping until one is available. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                else:
+                    wait = (1 - self.tokens) / self.rate
+
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def penalize(self, seconds: float):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 8.0,
+                  retry_after: Optional[float] = None) -> float:
+    """Exponential backoff with jitter; an upstream Retry-After always wins."""
+    if retry_after is not None:
+        return retry_after
+    return min(cap, base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+
+class _Flight:
+    def __init__(self, start: datetime, end: datetime):
+        self.start = start
+        self.end = end
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self._done = threading.Event()
+
+    def wait(self) -> Any:
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class IntervalSingleFlight:
+    """
+    Coalesces concurrent fetches of time windows that share a key.
+
+    - A request fully covered by an in-flight window waits for it and reuses the result.
+    - A request that partially overlaps an in-flight window reuses the shared part
+      and only fetches the uncovered remainder.
+    - Otherwise the caller becomes the leader and runs `fetch` itself.
+    `clip(result, start, end)` trims a shared result to the requested window.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, List[_Flight]] = {}
+        self._lock = threading.Lock()
+
+    def do(
+        self,
+        key: Hashable,
+        start: datetime,
+        end: datetime,
+        fetch: Callable[[datetime, datetime], List[Any]],
+        clip: Callable[[List[Any], datetime, datetime], List[Any]],
+    ) -> List[Any]:
+        with self._lock:
+            flights = self._flights.setdefault(key, [])
+            shared = next((f for f in flights if f.start <= start and f.end >= end), None)
+            if shared is None:
+                shared = next((f for f in flights if f.start < end and f.end > start), None)
+            own = None
+            if shared is None:
+                own = _Flight(start, end)
+                flights.append(own)
+
+        if own is None:
+            result = clip(shared.wait(), start, end)
+            if start < shared.start:
+                result = self.do(key, start, shared.start, fetch, clip) + result
+            if end > shared.end:
+                result = result + self.do(key, shared.end, end, fetch, clip)
+            return result
+
+        try:
+            own.result = fetch(start, end)
+            return own.result
+        except BaseException as error:
+            own.error = error
+            raise
+        finally:
+            own._done.set()
+            with self._lock:
+                flights.remove(own)
+                if not flights and self._flights.get(key) is flights:
+                    del self._flights[key]